@@ -1,42 +1,237 @@
 import os
 import io
 import csv
+import hmac
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from flask import Flask, render_template, jsonify, Response
+from urllib.parse import urlencode
+import orjson
+from flask import Flask, render_template, jsonify, request, Response
+from flask.json.provider import JSONProvider
+from flask_caching import Cache
+from flask_compress import Compress
+from werkzeug.http import remove_entity_headers
+
+class ORJSONProvider(JSONProvider):
+    """Serialize jsonify() responses with orjson instead of the stdlib json"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# In-memory response cache, keyed on a data version the writer bumps after
+# each commit. A response built from older rows is stored under the old
+# version's key, so it is never served once the new rows are visible.
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
+_data_version = 0
+
+def data_cache_key(*args, **kwargs):
+    """Cache key for the current path, query string and data version"""
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return f'view/{request.path}/v{_data_version}?{query}'
+
+# gzip/brotli for JSON and HTML responses
+Compress(app)
+
+# Suffixes Flask-Compress appends to ETags, e.g. "<etag>:gzip"
+COMPRESS_ETAG_ALGORITHMS = ('gzip', 'br', 'deflate')
+
+@app.after_request
+def conditional_get(response):
+    """Answer repeat polls with 304 Not Modified when the ETag still matches"""
+    etag, _ = response.get_etag()
+    if not etag or response.status_code != 200:
+        return response
+    
+    for tag in request.if_none_match.as_set():
+        base, _, algorithm = tag.rpartition(':')
+        if tag == etag or (algorithm in COMPRESS_ETAG_ALGORITHMS and base == etag):
+            # Keep the response's own headers (Cache-Control, Vary, ...) and
+            # drop only the body and the headers describing it. Flask-Compress
+            # skips 304s, so echo the client's tag to keep any ":gzip" suffix.
+            response.status_code = 304
+            response.set_data(b'')
+            remove_entity_headers(response.headers)
+            response.set_etag(tag)
+            return response
+    
+    return response
 
 # Database configuration
 DATABASE = 'health.db'
+READ_POOL_SIZE = 7
+WRITE_BATCH_MAX_ROWS = 1000
+
+# Upload record keys, in daily_health column order
+DAILY_HEALTH_COLUMNS = (
+    'date', 'steps', 'distance_meters', 'resting_heart_rate', 'max_heart_rate',
+    'sleep_duration_seconds', 'sleep_score', 'body_battery', 'respiration_rate',
+    'spo2_avg', 'vo2_max'
+)
+
+# WITHOUT ROWID stores each row in the date primary key B-tree itself,
+# so lookups and upserts touch one tree instead of a table plus an index
+DAILY_HEALTH_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        date TEXT PRIMARY KEY,
+        steps INTEGER,
+        distance_meters INTEGER,
+        resting_heart_rate INTEGER,
+        max_heart_rate INTEGER,
+        sleep_duration_seconds INTEGER,
+        sleep_score INTEGER,
+        body_battery INTEGER,
+        respiration_rate INTEGER,
+        spo2_avg INTEGER,
+        vo2_max REAL
+    ) WITHOUT ROWID
+'''
+
+# Upsert updates an existing day in place; INSERT OR REPLACE would delete
+# and re-insert the row. The WHERE clause skips days whose values haven't
+# changed, so re-sent history doesn't dirty any pages.
+INSERT_DAILY_HEALTH_SQL = (
+    f"INSERT INTO daily_health ({', '.join(DAILY_HEALTH_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(DAILY_HEALTH_COLUMNS))}) "
+    f"ON CONFLICT(date) DO UPDATE SET "
+    f"({', '.join(DAILY_HEALTH_COLUMNS[1:])}) = "
+    f"({', '.join(f'excluded.{col}' for col in DAILY_HEALTH_COLUMNS[1:])}) "
+    f"WHERE ({', '.join(f'daily_health.{col}' for col in DAILY_HEALTH_COLUMNS[1:])}) IS NOT "
+    f"({', '.join(f'excluded.{col}' for col in DAILY_HEALTH_COLUMNS[1:])})"
+)
+
+def get_db_connection(readonly=False):
+    """Open a database connection with performance PRAGMAs applied"""
+    if readonly:
+        conn = sqlite3.connect(f'file:{DATABASE}?mode=ro', uri=True,
+                               check_same_thread=False, isolation_level=None)
+    else:
+        conn = sqlite3.connect(DATABASE, check_same_thread=False,
+                               isolation_level=None)
+    # synchronous=NORMAL is safe under WAL and only fsyncs at checkpoints
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')  # ~20MB page cache
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')  # 256MB
+    return conn
 
 def init_db():
     """Initialize the database"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db_connection()
     c = conn.cursor()
     
+    # WAL lets dashboard reads run alongside uploads. The setting is stored
+    # in the database file and creates health.db-wal / health.db-shm files.
+    c.execute('PRAGMA journal_mode=WAL')
+    
     # Create daily health table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS daily_health (
-            date TEXT PRIMARY KEY,
-            steps INTEGER,
-            distance_meters INTEGER,
-            resting_heart_rate INTEGER,
-            max_heart_rate INTEGER,
-            sleep_duration_seconds INTEGER,
-            sleep_score INTEGER,
-            body_battery INTEGER,
-            respiration_rate INTEGER,
-            spo2_avg INTEGER,
-            vo2_max REAL
-        )
-    ''')
+    c.execute(DAILY_HEALTH_TABLE_SQL.format(table='daily_health'))
+    
+    # Databases created before WITHOUT ROWID keep a separate rowid table
+    # next to the date index; copy them over to the new layout once
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'daily_health'")
+    if 'WITHOUT ROWID' not in c.fetchone()[0].upper():
+        columns = ', '.join(DAILY_HEALTH_COLUMNS)
+        c.execute('BEGIN')
+        c.execute(DAILY_HEALTH_TABLE_SQL.format(table='daily_health_new'))
+        c.execute(f'''
+            INSERT INTO daily_health_new ({columns})
+            SELECT {columns} FROM daily_health WHERE date IS NOT NULL
+        ''')
+        c.execute('DROP TABLE daily_health')
+        c.execute('ALTER TABLE daily_health_new RENAME TO daily_health')
+        conn.commit()
     
     conn.commit()
     conn.close()
 
-# Initialize database on startup
+def init_pool():
+    """Open the shared connections reused across requests"""
+    write_pool = queue.Queue(maxsize=1)
+    write_pool.put(get_db_connection())
+    
+    read_pool = queue.Queue(maxsize=READ_POOL_SIZE)
+    for _ in range(READ_POOL_SIZE):
+        read_pool.put(get_db_connection(readonly=True))
+    
+    return write_pool, read_pool
+
+@contextmanager
+def borrow_conn(readonly=False):
+    """Borrow a pooled connection: one writer, several WAL readers"""
+    pool = _READ_POOL if readonly else _WRITE_POOL
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+class PendingWrite:
+    """Rows from one upload, waiting for the writer thread to commit them"""
+    
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.error = None
+
+def save_rows(conn, batch):
+    """Upsert the rows of several uploads in one transaction"""
+    global _data_version
+    try:
+        conn.execute('BEGIN')
+        for pending in batch:
+            conn.executemany(INSERT_DAILY_HEALTH_SQL, pending.rows)
+        conn.commit()
+    except Exception as e:
+        # Catch everything so an unexpected error can't kill the writer thread
+        conn.rollback()
+        return e
+    # Cached dashboard responses are now stale
+    _data_version += 1
+    return None
+
+def writer_loop():
+    """Commit queued uploads, grouping whatever arrived during the last commit"""
+    while True:
+        batch = [_WRITE_QUEUE.get()]
+        row_count = len(batch[0].rows)
+        while row_count < WRITE_BATCH_MAX_ROWS:
+            try:
+                pending = _WRITE_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(pending)
+            row_count += len(pending.rows)
+        
+        with borrow_conn() as conn:
+            error = save_rows(conn, batch)
+            if error is None:
+                for pending in batch:
+                    pending.done.set()
+                continue
+            
+            # Retry uploads one at a time so a bad one doesn't fail the rest
+            for pending in batch:
+                pending.error = save_rows(conn, [pending]) if len(batch) > 1 else error
+                pending.done.set()
+
+# Initialize database and connection pool on startup
 init_db()
+_WRITE_POOL, _READ_POOL = init_pool()
+
+# All uploads are written by a single background thread
+_WRITE_QUEUE = queue.Queue()
+threading.Thread(target=writer_loop, daemon=True).start()
 
 @app.route('/')
 def index():
@@ -46,13 +241,13 @@ def index():
 @app.route('/api/upload', methods=['POST'])
 def api_upload():
     """Receive health data from local sync script"""
-    from flask import request
     
     # Verify API secret
-    api_secret = request.headers.get('X-API-Secret')
+    api_secret = request.headers.get('X-API-Secret', '')
     expected_secret = os.environ.get('API_SECRET', 'my-super-secret-key-12345')
     
-    if api_secret != expected_secret:
+    # Constant-time comparison so the secret can't be guessed by timing
+    if not api_secret or not hmac.compare_digest(api_secret.encode(), expected_secret.encode()):
         return jsonify({'error': 'Unauthorized'}), 401
     
     data = request.get_json()
@@ -61,80 +256,68 @@ def api_upload():
     
     health_data = data['health_data']
     
-    # Insert data into database
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+    # Skip non-object records and records without a date - it's the primary key
+    rows = [
+        tuple(map(record.get, DAILY_HEALTH_COLUMNS))
+        for record in health_data
+        if isinstance(record, dict) and record.get('date')
+    ]
     
-    saved_count = 0
-    for record in health_data:
-        try:
-            c.execute('''
-                INSERT OR REPLACE INTO daily_health 
-                (date, steps, distance_meters, resting_heart_rate, max_heart_rate,
-                 sleep_duration_seconds, sleep_score, body_battery, respiration_rate,
-                 spo2_avg, vo2_max)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                record.get('date'),
-                record.get('steps'),
-                record.get('distance_meters'),
-                record.get('resting_heart_rate'),
-                record.get('max_heart_rate'),
-                record.get('sleep_duration_seconds'),
-                record.get('sleep_score'),
-                record.get('body_battery'),
-                record.get('respiration_rate'),
-                record.get('spo2_avg'),
-                record.get('vo2_max')
-            ))
-            saved_count += 1
-        except Exception as e:
-            print(f"Error saving record: {e}")
+    # Hand the rows to the writer thread and wait for them to be committed
+    pending = PendingWrite(rows)
+    _WRITE_QUEUE.put(pending)
+    pending.done.wait()
     
-    conn.commit()
-    conn.close()
+    if pending.error:
+        app.logger.error('Error saving records', exc_info=pending.error)
+        return jsonify({'error': 'Failed to save data'}), 500
+    
+    saved_count = len(rows)
     
     return jsonify({'success': True, 'saved': saved_count})
 
 @app.route('/api/health-data')
+@cache.cached(make_cache_key=data_cache_key)
 def api_health_data():
-    """Get health data for specified number of days"""
-    from flask import request
-    days = int(request.args.get('days', 30))
+    """Get health data for specified number of days
     
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    Pass ?format=columns for a column-oriented payload (used by the dashboard).
+    """
+    days = request.args.get('days', 30, type=int)
     
-    c.execute('''
-        SELECT * FROM daily_health 
-        ORDER BY date DESC 
-        LIMIT ?
-    ''', (days,))
+    with borrow_conn(readonly=True) as conn:
+        c = conn.cursor()
+        
+        # Alias columns to the abbreviated field names used by the dashboard
+        c.execute('''
+            SELECT date, steps,
+                   distance_meters AS distance,
+                   resting_heart_rate AS resting_hr,
+                   max_heart_rate AS max_hr,
+                   sleep_duration_seconds AS sleep_duration,
+                   sleep_score, body_battery,
+                   respiration_rate AS respiration,
+                   spo2_avg, vo2_max
+            FROM daily_health 
+            ORDER BY date DESC 
+            LIMIT ?
+        ''', (days,))
+        
+        columns = [d[0] for d in c.description]
+        rows = c.fetchall()
     
-    rows = c.fetchall()
-    conn.close()
+    if request.args.get('format') == 'columns':
+        # One array per field instead of repeating every key on every row
+        data = {name: [row[i] for row in rows] for i, name in enumerate(columns)}
+    else:
+        data = [dict(zip(columns, row)) for row in rows]
     
-    # Convert to list of dicts with abbreviated field names for dashboard
-    data = []
-    for row in rows:
-        data.append({
-            'date': row['date'],
-            'steps': row['steps'],
-            'distance': row['distance_meters'],
-            'resting_hr': row['resting_heart_rate'],
-            'max_hr': row['max_heart_rate'],
-            'sleep_duration': row['sleep_duration_seconds'],
-            'sleep_score': row['sleep_score'],
-            'body_battery': row['body_battery'],
-            'respiration': row['respiration_rate'],
-            'spo2_avg': row['spo2_avg'],
-            'vo2_max': row['vo2_max']
-        })
-    
-    return jsonify(data)
+    response = jsonify(data)
+    response.add_etag()
+    return response
 
 @app.route('/api/daily-stats')
+@cache.cached(make_cache_key=data_cache_key)
 def api_daily_stats():
     """Alias for health-data endpoint (for dashboard compatibility)"""
     return api_health_data()
@@ -142,63 +325,83 @@ def api_daily_stats():
 @app.route('/api/export-csv')
 def export_csv():
     """Export health data as CSV with Average HR and sleep in hours"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    with borrow_conn(readonly=True) as conn:
+        has_data = conn.execute('SELECT 1 FROM daily_health LIMIT 1').fetchone()
     
-    c.execute('''
-        SELECT * FROM daily_health 
-        ORDER BY date DESC
-    ''')
-    
-    rows = c.fetchall()
-    conn.close()
-    
-    if not rows:
+    if not has_data:
         return "No data available", 404
     
-    # Create CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Write header with Average HR and sleep in hours
-    writer.writerow([
-        'Date', 'Steps', 'Distance (meters)', 'Resting HR', 'Average HR', 'Max HR',
-        'Sleep Duration (hours)', 'Sleep Score', 'Body Battery',
-        'Respiration Rate', 'SpO2 Avg', 'VO2 Max'
-    ])
-    
-    # Write data
-    for row in rows:
-        # Calculate Average HR (average of resting and max)
-        avg_hr = None
-        if row['resting_heart_rate'] and row['max_heart_rate']:
-            avg_hr = round((row['resting_heart_rate'] + row['max_heart_rate']) / 2)
+    def generate():
+        """Yield the CSV in chunks while reading rows from the database"""
+        output = io.StringIO()
+        writer = csv.writer(output)
         
-        # Convert sleep from seconds to hours
-        sleep_hours = None
-        if row['sleep_duration_seconds']:
-            sleep_hours = round(row['sleep_duration_seconds'] / 3600, 1)
+        def flush():
+            chunk = output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            return chunk
         
+        # Write header with Average HR and sleep in hours
         writer.writerow([
-            row['date'],
-            row['steps'],
-            row['distance_meters'],
-            row['resting_heart_rate'],
-            avg_hr,  # NEW: Average HR column
-            row['max_heart_rate'],
-            sleep_hours,  # FIXED: Sleep in hours instead of seconds
-            row['sleep_score'],
-            row['body_battery'],
-            row['respiration_rate'],
-            row['spo2_avg'],
-            row['vo2_max']
+            'Date', 'Steps', 'Distance (meters)', 'Resting HR', 'Average HR', 'Max HR',
+            'Sleep Duration (hours)', 'Sleep Score', 'Body Battery',
+            'Respiration Rate', 'SpO2 Avg', 'VO2 Max'
         ])
+        yield flush()
+        
+        # The connection stays borrowed until the last chunk is sent
+        with borrow_conn(readonly=True) as conn:
+            c = conn.cursor()
+            c.arraysize = 1000
+            
+            c.execute('''
+                SELECT date, steps, distance_meters, resting_heart_rate,
+                       max_heart_rate, sleep_duration_seconds, sleep_score,
+                       body_battery, respiration_rate, spo2_avg, vo2_max
+                FROM daily_health 
+                ORDER BY date DESC
+            ''')
+            
+            while True:
+                rows = c.fetchmany()
+                if not rows:
+                    break
+                
+                # Write data
+                for (date, steps, distance_meters, resting_hr, max_hr,
+                     sleep_seconds, sleep_score, body_battery, respiration_rate,
+                     spo2_avg, vo2_max) in rows:
+                    # Calculate Average HR (average of resting and max)
+                    avg_hr = None
+                    if resting_hr and max_hr:
+                        avg_hr = round((resting_hr + max_hr) / 2)
+                    
+                    # Convert sleep from seconds to hours
+                    sleep_hours = None
+                    if sleep_seconds:
+                        sleep_hours = round(sleep_seconds / 3600, 1)
+                    
+                    writer.writerow([
+                        date,
+                        steps,
+                        distance_meters,
+                        resting_hr,
+                        avg_hr,  # NEW: Average HR column
+                        max_hr,
+                        sleep_hours,  # FIXED: Sleep in hours instead of seconds
+                        sleep_score,
+                        body_battery,
+                        respiration_rate,
+                        spo2_avg,
+                        vo2_max
+                    ])
+                
+                yield flush()
     
-    # Generate response
-    output.seek(0)
+    # Stream the response
     return Response(
-        output.getvalue(),
+        generate(),
         mimetype='text/csv',
         headers={'Content-Disposition': f'attachment; filename=health_data_{datetime.now().strftime("%Y%m%d")}.csv'}
     )
@@ -3,22 +3,29 @@ Use garminconnect library after loading tokens with garth
 The library might know the right endpoints/methods
 """
 
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 import sqlite3
 import os
 import sys
-import json
+import logging
 import base64
-import garth
+import time
+import orjson
+from garth.auth_tokens import OAuth1Token, OAuth2Token
 from garminconnect import Garmin
 
 TOKEN_ENV_VAR = 'GARMIN_TOKENS_BASE64'
-TOKEN_DIR = '/tmp/.garminconnect'
+TOKEN_REFRESH_MARGIN = 5 * 60  # seconds
 DATABASE = 'health.db'
 DAYS_TO_FETCH = int(os.environ.get('DAYS_TO_FETCH', '7'))  # Just 7 for testing
 
+logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                    level=logging.INFO, stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
 def log(message):
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+    logger.info(message)
 
 def init_database():
     conn = sqlite3.connect(DATABASE)
@@ -35,60 +42,67 @@ def init_database():
     conn.commit()
     conn.close()
 
+def load_tokens(client, encoded_tokens):
+    """Configure the client's garth session straight from the token env var"""
+    # orjson parses the decoded bytes directly, no str round-trip
+    tokens = orjson.loads(base64.b64decode(encoded_tokens))
+    client.garth.configure(
+        oauth1_token=OAuth1Token(**tokens['oauth1_token']),
+        oauth2_token=OAuth2Token(**tokens['oauth2_token']),
+        domain=tokens['oauth1_token'].get('domain'),
+    )
+    # Garmin.login() would normally set this; get_stats needs it
+    client.display_name = client.garth.profile['displayName']
+
 def main():
     log("=" * 70)
     log("Testing garminconnect library with pre-loaded tokens")
     log("=" * 70)
     log("")
     
-    # Load tokens with garth first
     encoded_tokens = os.environ.get(TOKEN_ENV_VAR)
-    json_str = base64.b64decode(encoded_tokens).decode()
-    tokens = json.loads(json_str)
-    
-    os.makedirs(TOKEN_DIR, exist_ok=True)
-    
-    with open(os.path.join(TOKEN_DIR, 'oauth1_token.json'), 'w') as f:
-        json.dump(tokens['oauth1_token'], f)
-    
-    with open(os.path.join(TOKEN_DIR, 'oauth2_token.json'), 'w') as f:
-        json.dump(tokens['oauth2_token'], f)
-    
-    # Resume garth session
-    log("Loading tokens with garth...")
-    garth.resume(TOKEN_DIR)
-    log("Garth session loaded")
-    log("")
     
     # Now create Garmin client
-    # It should automatically use the tokens from ~/.garminconnect
     log("Creating Garmin client...")
     try:
         client = Garmin()
         log("Garmin client created!")
         log("")
         
+        # Load the tokens into the client's own garth session (not garth's
+        # global one) so every call below shares its connections and token.
+        # Built in memory, so nothing is written to disk and read back
+        log("Loading tokens with garth...")
+        load_tokens(client, encoded_tokens)
+        log("Garth session loaded")
+        
+        # Refresh once up front if the token is about to expire, instead of
+        # each concurrent request below refreshing it separately
+        if client.garth.oauth2_token.expires_at - time.time() < TOKEN_REFRESH_MARGIN:
+            log("OAuth2 token about to expire, refreshing...")
+            client.garth.refresh_oauth2()
+        log("")
+        
         # Try to get stats directly
         log("Attempting to get user stats...")
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        try:
-            stats = client.get_stats(today)
-            log(f"SUCCESS! Got stats: {stats}")
-        except Exception as e:
-            log(f"get_stats failed: {e}")
+        today = date.today().isoformat()
         
-        try:
-            steps = client.get_steps_data(today)
-            log(f"SUCCESS! Got steps: {steps}")
-        except Exception as e:
-            log(f"get_steps_data failed: {e}")
+        # The endpoints are independent, so request them concurrently
+        endpoints = [
+            ('stats', client.get_stats),
+            ('steps', client.get_steps_data),
+            ('heart rate', client.get_heart_rates),
+        ]
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            futures = [(name, method, executor.submit(method, today))
+                       for name, method in endpoints]
         
-        try:
-            heart = client.get_heart_rates(today)
-            log(f"SUCCESS! Got heart rate: {heart}")
-        except Exception as e:
-            log(f"get_heart_rates failed: {e}")
+        for name, method, future in futures:
+            try:
+                response = orjson.dumps(future.result(), default=str).decode()
+                log(f"SUCCESS! Got {name}: {response}")
+            except Exception as e:
+                log(f"{method.__name__} failed: {e}")
             
     except Exception as e:
         log(f"ERROR creating Garmin client: {e}")